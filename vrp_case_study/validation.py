@@ -1,11 +1,21 @@
 """This script provides functionality to import data and convert it to usable forms."""
 import json
-from math import inf, floor
+import re
+import shelve
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+from itertools import groupby, takewhile
+from math import floor
+from operator import itemgetter
 from time import perf_counter
-from typing import List, Optional, Tuple, Union, Dict
+from typing import List, Optional, Tuple, Union, Dict, MutableMapping, Iterator
 
 import requests
-from openpyxl import load_workbook
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from openpyxl import Workbook, load_workbook
+from openpyxl.worksheet._read_only import ReadOnlyWorksheet
 from openpyxl.worksheet.worksheet import Worksheet
 
 from bing_key import api_key
@@ -14,9 +24,43 @@ from main import Runner
 from model import run_settings
 from settings import Data
 
+# The "target offload time" strings have the average offload time in brackets, as minutes:seconds
+_OFFLOAD_TIME_PATTERN = re.compile(r"\(\s*(\d+)\s*:\s*(\d+)")
+# Pallet counts stored as text are whole numbers, possibly signed and padded with spaces
+_PALLETS_PATTERN = re.compile(r"\s*[+-]?\d+\s*")
+
+
+@contextmanager
+def open_read_only(filename: str, workbook: Optional[Workbook] = None, **kwargs) -> Iterator[Workbook]:
+    """Opens a workbook for reading, for use in a with statement. Read-only workbooks keep their file open until they
+    are closed, so the file is closed again once the with block is left.
+
+    :param filename: The file to open if no workbook is given.
+    :param workbook: A workbook that is already open. It is given back as it is, and is left open afterwards.
+    :param kwargs: Other arguments for load_workbook, such as data_only.
+    :returns: The open workbook."""
+    if workbook is not None:
+        yield workbook
+        return
+    workbook = load_workbook(filename=filename, read_only=True, **kwargs)
+    try:
+        yield workbook
+    finally:
+        workbook.close()
+
+
+def _get_sheet(workbook: Workbook, sheetname: str) -> Union[Worksheet, ReadOnlyWorksheet]:
+    """Gets a sheet whose rows are about to be read. Read-only sheets stop at the dimensions stored in the file, which
+    are sometimes wrong, so they are made to work out their size while they are read instead."""
+    sheet = workbook[sheetname]
+    if isinstance(sheet, ReadOnlyWorksheet):
+        sheet.reset_dimensions()
+    return sheet
+
 
 class ArcVehicleType:
     """Stores information about a vehicle type."""
+    __slots__ = ("data_index", "name", "distance_cost", "time_cost", "capacity", "vehicles_available", "vehicles_used")
 
     def __init__(self, data_index: int, name: str, distance_cost: float, time_cost: float, capacity: int,
                  vehicles_available: int):
@@ -28,84 +72,75 @@ class ArcVehicleType:
         self.vehicles_available = vehicles_available
         self.vehicles_used = 0
 
-    def __eq__(self, other):
-        if isinstance(other, ArcVehicleType):
-            return other.data_index == self.data_index or other.name == self.name
-        if isinstance(other, ArcVehicle):
-            return other.vehicle_type == self
-        return False
-
 
 class ArcVehicle:
     """Stores information about a vehicle."""
+    __slots__ = ("name", "vehicle_type")
 
     def __init__(self, name: str, vehicle_type: ArcVehicleType):
         self.name = name
         self.vehicle_type = vehicle_type
 
-    def __eq__(self, other):
-        if isinstance(other, ArcVehicle):
-            return other.name == self.name
-        return False
-
     @staticmethod
     def read_vehicles(vehicles_file: str, vehicles_sheet: str = "trucks", types_file: str = "Model Data.xlsx",
-                      types_sheet: str = "Vehicle Types") -> Tuple[List[ArcVehicleType], List["ArcVehicle"]]:
+                      types_sheet: str = "Vehicle Types", types_workbook: Optional[Workbook] = None) -> Tuple[
+        List[ArcVehicleType], List["ArcVehicle"]]:
         """Reads in information about the vehicle types and vehicles."""
-        types_workbook = load_workbook(filename=types_file, read_only=True)
-        types_sheet = types_workbook[types_sheet]
-        vehicle_types: List[ArcVehicleType] = []
-        row = 2
-        while types_sheet[f"A{row}"].value:
-            vehicle_types.append(ArcVehicleType(row - 2, name=types_sheet[f"A{row}"].value,
-                                                distance_cost=types_sheet[f"B{row}"].value,
-                                                time_cost=types_sheet[f"C{row}"].value,
-                                                capacity=types_sheet[f"D{row}"].value,
-                                                vehicles_available=types_sheet[f"E{row}"].value))
-            row += 1
-
-        vehicles_workbook = load_workbook(filename=vehicles_file, read_only=True)
-        vehicles_sheet = vehicles_workbook[vehicles_sheet]
-        vehicles: List[ArcVehicle] = []
-        row = 2
-        capacities = [vehicle_type.capacity for vehicle_type in vehicle_types]
-        while vehicles_sheet[f"A{row}"].value:
-            try:
-                capacity = int(vehicles_sheet[f"C{row}"].value)
-                vehicles.append(ArcVehicle(name=vehicles_sheet[f"A{row}"].value,
-                                           vehicle_type=vehicle_types[capacities.index(capacity)]))
-            except (ValueError, TypeError):
-                pass
-            row += 1
+        with open_read_only(types_file, types_workbook) as types_workbook:
+            types_sheet = _get_sheet(types_workbook, types_sheet)
+            vehicle_types: List[ArcVehicleType] = []
+            for index, row in enumerate(types_sheet.iter_rows(min_row=2, max_col=5, values_only=True)):
+                if not row[0]:
+                    break
+                vehicle_types.append(ArcVehicleType(index, name=row[0], distance_cost=row[1], time_cost=row[2],
+                                                    capacity=row[3], vehicles_available=row[4]))
+
+        with open_read_only(vehicles_file) as vehicles_workbook:
+            vehicles_sheet = _get_sheet(vehicles_workbook, vehicles_sheet)
+            vehicles: List[ArcVehicle] = []
+            # Built in reverse so that the first vehicle type with a capacity is the one that is kept
+            capacity_types = {vehicle_type.capacity: vehicle_type for vehicle_type in reversed(vehicle_types)}
+            for name, _, capacity_value in vehicles_sheet.iter_rows(min_row=2, max_col=3, values_only=True):
+                if not name:
+                    break
+                try:
+                    capacity = int(capacity_value)
+                except (ValueError, TypeError):
+                    continue
+                vehicle_type = capacity_types.get(capacity)
+                if vehicle_type:
+                    vehicles.append(ArcVehicle(name=name, vehicle_type=vehicle_type))
 
         return vehicle_types, vehicles
 
     @staticmethod
-    def find_vehicle(horse: str, trailer: str, carried: int, vehicles: List["ArcVehicle"],
-                     vehicle_types: List[ArcVehicleType]) -> Optional["ArcVehicle"]:
-        """Searches the list of vehicles for one that contains the given vehicle name."""
-        try:
+    def build_vehicle_index(vehicles: List["ArcVehicle"]) -> Dict[str, "ArcVehicle"]:
+        """Creates a dict that maps each vehicle name to its vehicle."""
+        return {vehicle.name: vehicle for vehicle in vehicles}
+
+    @staticmethod
+    def find_vehicle(horse: str, trailer: str, carried: int, vehicle_types: List[ArcVehicleType],
+                     vehicle_index: Optional[Dict[str, "ArcVehicle"]] = None) -> Optional["ArcVehicle"]:
+        """Searches the vehicle index (if one is given) for one that matches the given vehicle name. Otherwise, the
+        vehicle type with the closest capacity is used."""
+        if vehicle_index is not None:
             # Check if there is a vehicle that matches the horse code
-            return vehicles[vehicles.index(horse)]
-        except ValueError:
-            try:
+            vehicle = vehicle_index.get(horse)
+            if vehicle is None:
                 # Check if there is a vehicle that matches the trailer code
-                return vehicles[vehicles.index(trailer)]
-            except ValueError:
-                try:
-                    # Otherwise, try find the vehicle type that has the most similar to the capacity to the load carried
-                    lowest_diff = inf
-                    closest_type = None
-                    for vehicle_type in vehicle_types:
-                        diff = abs(vehicle_type.capacity - carried)
-                        if diff < lowest_diff:
-                            lowest_diff = diff
-                            closest_type = vehicle_type
+                vehicle = vehicle_index.get(trailer)
+            if vehicle is not None:
+                return vehicle
 
-                    return ArcVehicle(horse, closest_type)
+        try:
+            # Otherwise, try find the vehicle type that has the most similar to the capacity to the load carried.
+            # min keeps the first of any tied types.
+            closest_type = min(vehicle_types, key=lambda vehicle_type: abs(vehicle_type.capacity - carried))
 
-                except (ValueError, TypeError):
-                    return None
+            return ArcVehicle(horse, closest_type)
+
+        except (ValueError, TypeError):
+            return None
 
 
 class ArcLocation:
@@ -113,6 +148,7 @@ class ArcLocation:
     as SPAR, SUPERSPAR, KWIKSPAR, TOPS, and PHARMACY at the same location are treated as separate customers by SPAR.
 
     This script will treat stores at the same location as the same customer."""
+    __slots__ = ("data_index", "name", "latitude", "longitude", "average_offload_time", "store_ids", "demand")
 
     def __init__(self, data_index: int, name: str, latitude: float, longitude: float, offload: Union[str, float],
                  stores: str):
@@ -136,16 +172,10 @@ class ArcLocation:
         return f"ArcLocation {self.name}, with store IDs {self.store_ids}."
 
     def __eq__(self, other):
-        if isinstance(other, ArcLocation):
-            return other.name == self.name
-        if isinstance(other, int):
-            return self.store_ids.count(other) > 0
-        if isinstance(other, str):
-            try:
-                return self.store_ids.count(int(other)) > 0
-            except (ValueError, TypeError):
-                return False
-        return False
+        return isinstance(other, ArcLocation) and other.data_index == self.data_index
+
+    def __hash__(self):
+        return hash(self.data_index)
 
     @property
     def anonymous_name(self) -> str:
@@ -159,9 +189,10 @@ class ArcLocation:
         :param offload_str: String containing the target offload time and the target offload time.
         :returns: Integer representing the average offload time in hours.
         """
-        timestamp = offload_str[offload_str.index("(") + 1:offload_str.index(")")]
-        time_units = timestamp.split(":")
-        offload_time = (int(time_units[0]) * 60 + int(time_units[1])) / 3600
+        match = _OFFLOAD_TIME_PATTERN.search(offload_str)
+        if match is None:
+            raise ValueError(f"No average offload time found in {offload_str!r}.")
+        offload_time = (int(match.group(1)) * 60 + int(match.group(2))) / 3600
 
         # If there is no average offload time stored, then set it to 5.5 minutes
         if offload_time == 0:
@@ -175,152 +206,205 @@ class ArcLocation:
 
         :param stores_str: String containing a list of stores at the location.
         :returns: A list of the IDs of stores at that location."""
-        stores = stores_str[4:].split(", ")
-        store_codes: List[int] = []
-        for store in stores:
-            store_code = store.split("-")[0]
-            if store_code:
-                store_codes.append(int(store_code))
-
-        return store_codes
+        # Each store starts with "<store ID>-", and int() allows for any spaces around the ID
+        store_codes = (store.partition("-")[0] for store in stores_str[4:].split(", "))
+        return [int(store_code) for store_code in store_codes if store_code]
 
     @staticmethod
-    def read_locations(filename: str = "Model Data.xlsx", sheetname: str = "Locations") -> List["ArcLocation"]:
+    def read_locations(filename: str = "Model Data.xlsx", sheetname: str = "Locations",
+                       workbook: Optional[Workbook] = None) -> List["ArcLocation"]:
         """Reads in the store locations and creates a list of ArcLocation objects."""
-        workbook = load_workbook(filename=filename, read_only=True)
-        locations_sheet = workbook[sheetname]
-        locations: List[ArcLocation] = [ArcLocation(0, "Depot", -34.005993, 18.537626, 0.09167, "")]
-        row = 2
-        while locations_sheet[f"A{row}"].value:
-            locations.append(ArcLocation(data_index=row - 1, name=locations_sheet[f"A{row}"].value,
-                                         latitude=locations_sheet[f"B{row}"].value,
-                                         longitude=locations_sheet[f"C{row}"].value,
-                                         offload=locations_sheet[f"E{row}"].value,
-                                         stores=locations_sheet[f"F{row}"].value))
-            row += 1
+        with open_read_only(filename, workbook) as workbook:
+            locations_sheet = _get_sheet(workbook, sheetname)
+            locations: List[ArcLocation] = [ArcLocation(0, "Depot", -34.005993, 18.537626, 0.09167, "")]
+            for index, row in enumerate(locations_sheet.iter_rows(min_row=2, max_col=6, values_only=True), start=1):
+                if not row[0]:
+                    break
+                locations.append(ArcLocation(data_index=index, name=row[0], latitude=row[1], longitude=row[2],
+                                             offload=row[4], stores=row[5]))
         return locations
 
     @staticmethod
-    def find_location(store_code: int, locations: List["ArcLocation"]) -> Optional["ArcLocation"]:
-        """Searches the list of locations for one that contains the given store ID."""
-        # Hopefully List.index can utilise the custom __eq__ function for ArcLocation.
+    def build_store_index(locations: List["ArcLocation"]) -> Dict[int, "ArcLocation"]:
+        """Creates a dict that maps each store ID to the location that the store is at."""
+        store_index: Dict[int, ArcLocation] = {}
+        for location in locations:
+            for store_id in location.store_ids:
+                # If a store ID appears more than once, keep the first location it was found at
+                store_index.setdefault(store_id, location)
+        return store_index
+
+    @staticmethod
+    def find_location(store_code: Union[int, str], store_index: Dict[int, "ArcLocation"]) -> Optional["ArcLocation"]:
+        """Searches the store index for the location that contains the given store ID."""
         try:
-            return locations[locations.index(store_code)]
-        except ValueError:
+            return store_index.get(int(store_code))
+        except (ValueError, TypeError):
             return None
 
     @staticmethod
-    def pull_travel_data_from_bing(locations: List["ArcLocation"]) -> Tuple[List[List[float]], List[List[float]]]:
-        """Will generate a travel time and distance matrix between all locations using Bing Maps."""
+    def pull_travel_data_from_bing(locations: List["ArcLocation"], cache_filename: Optional[str] = None,
+                                   max_requests: int = 8, max_retries: int = 5) -> Tuple[
+        List[List[float]], List[List[float]]]:
+        """Will generate a travel time and distance matrix between all locations using Bing Maps.
+
+        :param locations: The locations to find the travel distances and times between.
+        :param cache_filename: File to store the Bing responses in, so that repeated requests aren't sent again.
+        :param max_requests: The most requests to have waiting on Bing at the same time.
+        :param max_retries: How many times to resend a request that Bing rate limits or fails to respond to.
+        :returns: The distance and time matrices."""
         # Bing has a limit of 2500 origin-destination pairings for a distance matrix
         max_pairs = 2500
         # The locations will need to be iterated across with as many rows as possible at a time.
         rows_per_call = floor(max_pairs / len(locations))
         if rows_per_call == 0:
             raise ValueError("Too many locations!")
-        start_row = 0
+
+        print(rows_per_call)
+
+        # Keep going until all locations have been used as an origin to all other locations
+        blocks = [(start_row, min(start_row + rows_per_call, len(locations)))
+                  for start_row in range(0, len(locations), rows_per_call)]
+        # Every request sends all the locations as destinations, and some of them as origins, so the coordinates are
+        # only prepared once
+        coordinates = [{"latitude": location.latitude, "longitude": location.longitude} for location in locations]
+        bodies = [ArcLocation._travel_request_body(coordinates, start_row, end_row) for start_row, end_row in blocks]
+        keys = [blake2b(body.encode()).hexdigest() for body in bodies]
+
+        cache: MutableMapping[str, List[Dict[str, Union[int, float]]]] = shelve.open(
+            cache_filename) if cache_filename else {}
+        try:
+            block_matrices: Dict[int, Tuple[List[List[float]], List[List[float]]]] = {
+                index: ArcLocation._read_travel_results(cache[key], locations, *blocks[index])
+                for index, key in enumerate(keys) if key in cache}
+            uncached = [index for index, key in enumerate(keys) if key not in cache]
+            # Send the requests that haven't been cached at the same time, sharing connections between them
+            with requests.Session() as session, ThreadPoolExecutor(max_workers=max_requests) as executor:
+                # Back off and resend the requests that are rate limited or hit a server error. The last response is
+                # still returned if they all fail, so that Bing's error is reported.
+                retry = Retry(total=max_retries, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+                              allowed_methods=frozenset({"POST"}), raise_on_status=False)
+                session.mount("https://", HTTPAdapter(pool_connections=max_requests, pool_maxsize=max_requests,
+                                                      max_retries=retry))
+                responses = executor.map(lambda index: ArcLocation._post_travel_request(session, bodies[index]),
+                                         uncached)
+                # The responses are given in the same order as the requests. Each one is only cached once its results
+                # have been read, so that a bad response isn't replayed on later runs.
+                for index, results in zip(uncached, responses):
+                    block_matrices[index] = ArcLocation._read_travel_results(results, locations, *blocks[index])
+                    cache[keys[index]] = results
+        finally:
+            if cache_filename:
+                cache.close()
+
         distances: List[List[float]] = []
         times: List[List[float]] = []
+        for index in range(len(blocks)):
+            block_distances, block_times = block_matrices[index]
+            distances.extend(block_distances)
+            times.extend(block_times)
 
-        print(rows_per_call)
+        return distances, times
 
-        # Keep iterating until all locations have been used as an origin to all other locations
-        while start_row < len(locations):
-            # Use a POST request to get information from the Bing maps API.
-            # Example request and responses are found at
-            # https://docs.microsoft.com/en-us/bingmaps/rest-services/examples/distance-matrix-example
-
-            end_row = min(start_row + rows_per_call, len(locations))
-
-            # Prepare the data for the post
-            post_body = {"origins": [],
-                         "destinations": [],
-                         "travelMode": "driving"}
-            # Request information from the current set of origins to all destinations
-            for origin in locations[start_row:end_row]:
-                post_body["origins"].append({"latitude": origin.latitude, "longitude": origin.longitude})
-            for destination in locations:
-                post_body["destinations"].append({"latitude": destination.latitude, "longitude": destination.longitude})
-            print(post_body)
-
-            # Send the request
-            # Key in .gitignored file, because this repository is public.
-            response = requests.post(f"https://dev.virtualearth.net/REST/v1/Routes/DistanceMatrix?key={api_key}",
-                                     data=json.dumps(post_body))
-            # The response is in JSON format
-            # response: dict = json.loads(request.json())
-            response_json: dict = response.json()
-            if response_json["statusCode"] == 200:
-                # Only interested in the results from the response
-                results: List[Dict[str, Union[int, float]]] = response_json["resourceSets"][0]["resources"][0][
-                    "results"]
-                result_index = 0
-
-                # The results are a list of dicts, which iterate first through origins then destinations
-                for origin_index, origin in enumerate(locations[start_row:end_row]):
-                    origin_distances = []
-                    origin_times = []
-                    for destination_index, destination in enumerate(locations):
-                        # The response will exclude elements where the origin and destination are the same location
-                        # if origin == destination:
-                        #     continue
-
-                        # The dict contains the origin and destination
-                        if results[result_index]["destinationIndex"] != destination_index or \
-                                results[result_index]["destinationIndex"] != destination_index:
-                            raise ValueError(
-                                f"Distance Matrix result indices at {result_index} don't match expected indices "
-                                f"{origin_index} and {destination_index}.\n{results}")
-                        # Store the expected travel distance and duration
-                        origin_distances.append(results[result_index]["travelDistance"])
-                        # Bing gives the durations in minutes, my algorithm uses hours
-                        origin_times.append(results[result_index]["travelDuration"] / 60)
-
-                        result_index += 1
-
-                    distances.append(origin_distances)
-                    times.append(origin_times)
-                start_row = end_row
-            else:
-                raise ValueError(f"Request failed!\nRequest: {response.request}\nResponse: {response_json}")
+    @staticmethod
+    def _travel_request_body(coordinates: List[Dict[str, float]], start_row: int, end_row: int) -> str:
+        """Prepares the data for a distance matrix request from a set of origins to all destinations."""
+        # Request information from the current set of origins to all destinations
+        post_body = {"origins": coordinates[start_row:end_row],
+                     "destinations": coordinates,
+                     "travelMode": "driving"}
+        # The body is sent as it is, so leave out the whitespace
+        return json.dumps(post_body, separators=(",", ":"))
+
+    @staticmethod
+    def _post_travel_request(session: requests.Session, body: str) -> List[Dict[str, Union[int, float]]]:
+        """Sends a distance matrix request to Bing and returns the results from the response."""
+        # Use a POST request to get information from the Bing maps API.
+        # Example request and responses are found at
+        # https://docs.microsoft.com/en-us/bingmaps/rest-services/examples/distance-matrix-example
+        # Key in .gitignored file, because this repository is public.
+        response = session.post(f"https://dev.virtualearth.net/REST/v1/Routes/DistanceMatrix?key={api_key}",
+                                data=body)
+        # The response is in JSON format
+        response_json: dict = response.json()
+        if response_json["statusCode"] != 200:
+            raise ValueError(f"Request failed!\nRequest: {response.request}\nResponse: {response_json}")
+        # Only interested in the results from the response
+        return response_json["resourceSets"][0]["resources"][0]["results"]
+
+    @staticmethod
+    def _read_travel_results(results: List[Dict[str, Union[int, float]]], locations: List["ArcLocation"],
+                             start_row: int, end_row: int) -> Tuple[List[List[float]], List[List[float]]]:
+        """Converts the results of a distance matrix request into rows of the distance and time matrices."""
+        distances: List[List[float]] = []
+        times: List[List[float]] = []
+        result_index = 0
+
+        # The results are a list of dicts, which iterate first through origins then destinations
+        for origin_index, origin in enumerate(locations[start_row:end_row]):
+            origin_distances = []
+            origin_times = []
+            for destination_index, destination in enumerate(locations):
+                # The response will exclude elements where the origin and destination are the same location
+                # if origin == destination:
+                #     continue
+
+                # The dict contains the origin and destination
+                if results[result_index]["originIndex"] != origin_index or \
+                        results[result_index]["destinationIndex"] != destination_index:
+                    raise ValueError(
+                        f"Distance Matrix result indices at {result_index} don't match expected indices "
+                        f"{origin_index} and {destination_index}.\n{results}")
+                # Store the expected travel distance and duration
+                origin_distances.append(results[result_index]["travelDistance"])
+                # Bing gives the durations in minutes, my algorithm uses hours
+                origin_times.append(results[result_index]["travelDuration"] / 60)
+
+                result_index += 1
+
+            distances.append(origin_distances)
+            times.append(origin_times)
 
         return distances, times
 
     @staticmethod
-    def import_matrix_input_data(filename: str = "Model Data.xlsx") -> Tuple[List[List[float]], List[List[float]]]:
+    def import_matrix_input_data(filename: str = "Model Data.xlsx", workbook: Optional[Workbook] = None) -> Tuple[
+        List[List[float]], List[List[float]]]:
         """Reads the matrices from the model data sheet."""
-        workbook = load_workbook(filename, read_only=True, data_only=True)
-        # distance_sheet: Worksheet = workbook["Distances"]
-        # time_sheet: Worksheet = workbook["Times"]
-        # row = 2
-        # times: List[List[float]] = []
-        # distances: List[List[float]] = []
-        # while distance_sheet.cell(row=row, column=1).value:
-        #     column = 2
-        #     distance_row = []
-        #     time_row = []
-        #     while distance_sheet.cell(row=1, column=column).value:
-        #         distance_row.append(distance_sheet.cell(row=row, column=column).value)
-        #         time_row.append(time_sheet.cell(row=row, column=column).value)
-        #
-        #         column += 1
-        #
-        #     distances.append(distance_row)
-        #     times.append(time_row)
-        #     print(f"Row {row}")
-        #
-        #     row += 1
-
-        # With the workbook opened in read only, it the worksheets are iterable objects
-        distance_sheet: Worksheet = workbook["Distances"]
-        time_sheet: Worksheet = workbook["Times"]
-        distances: List[List[float]] = [[distance.value for distance in distance_row] for distance_row in
-                                        distance_sheet]
-        times: List[List[float]] = [[time.value for time in time_row] for time_row in time_sheet]
-
-        # Can't use slices to cut the worksheets, so must cut the lists after taking the values from the sheets
-        distances = [[distance for distance in distance_row[1:]] for distance_row in distances[1:]]
-        times = [[time for time in time_row[1:]] for time_row in times[1:]]
+        with open_read_only(filename, workbook, data_only=True) as workbook:
+            # distance_sheet: Worksheet = workbook["Distances"]
+            # time_sheet: Worksheet = workbook["Times"]
+            # row = 2
+            # times: List[List[float]] = []
+            # distances: List[List[float]] = []
+            # while distance_sheet.cell(row=row, column=1).value:
+            #     column = 2
+            #     distance_row = []
+            #     time_row = []
+            #     while distance_sheet.cell(row=1, column=column).value:
+            #         distance_row.append(distance_sheet.cell(row=row, column=column).value)
+            #         time_row.append(time_sheet.cell(row=row, column=column).value)
+            #
+            #         column += 1
+            #
+            #     distances.append(distance_row)
+            #     times.append(time_row)
+            #     print(f"Row {row}")
+            #
+            #     row += 1
+
+            # Skip the row and column of location names, and only take the values so that no cells are created.
+            # As before, the matrix ends at the first blank location name in the header row and in column A.
+            distance_sheet = _get_sheet(workbook, "Distances")
+            time_sheet = _get_sheet(workbook, "Times")
+            header = next(distance_sheet.iter_rows(min_row=1, max_row=1, min_col=2, values_only=True), ())
+            width = len(list(takewhile(bool, header)))
+            distance_rows = takewhile(lambda row: row[0],
+                                      distance_sheet.iter_rows(min_row=2, max_col=width + 1, values_only=True))
+            distances: List[List[float]] = [list(distance_row[1:]) for distance_row in distance_rows]
+            time_rows = time_sheet.iter_rows(min_row=2, max_row=len(distances) + 1, max_col=width + 1,
+                                             values_only=True)
+            times: List[List[float]] = [list(time_row[1:]) for time_row in time_rows]
 
         return distances, times
 
@@ -331,39 +415,33 @@ class ArcLocation:
         """Saves the matrix information to the model data sheet."""
         workbook = load_workbook(filename)
 
-        # Add the location distances and times
-        distances_sheet: Worksheet = workbook["Distances"]
-        times_sheet: Worksheet = workbook["Times"]
-        for row, distances_row in enumerate(distances):
-            # Put location names at the start of each row
-            if anonymise:
-                distances_sheet.cell(row=row + 2, column=1, value=locations[row].anonymous_name)
-                times_sheet.cell(row=row + 2, column=1, value=locations[row].anonymous_name)
-            else:
-                distances_sheet.cell(row=row + 2, column=1, value=locations[row].name)
-                times_sheet.cell(row=row + 2, column=1, value=locations[row].name)
-            for col, distance in enumerate(distances_row):
-                if row == 0:
-                    # Put location names at the top of each column
-                    if anonymise:
-                        distances_sheet.cell(row=1, column=col + 2, value=locations[col].anonymous_name)
-                        times_sheet.cell(row=1, column=col + 2, value=locations[col].anonymous_name)
-                    else:
-                        distances_sheet.cell(row=1, column=col + 2, value=locations[col].name)
-                        times_sheet.cell(row=1, column=col + 2, value=locations[col].name)
-                if row == col:
-                    # If on the same row and col, set the travel to be equal to going to the depot and back
-                    dist = distances[row][0] + distances[0][row]
-                    time = times[row][0] + times[0][row]
-                else:
-                    dist = distances[row][col]
-                    time = times[row][col]
-                # Apply the value to the sheet
-                distances_sheet.cell(row=row + 2, column=col + 2, value=dist)
-                times_sheet.cell(row=row + 2, column=col + 2, value=time)
+        # Add the location distances and times, with location names at the top of each column and the start of each
+        # row
+        if anonymise:
+            names = [location.anonymous_name for location in locations]
+        else:
+            names = [location.name for location in locations]
+        ArcLocation._write_matrix(workbook["Distances"], names, distances)
+        ArcLocation._write_matrix(workbook["Times"], names, times)
 
         workbook.save(filename)
 
+    @staticmethod
+    def _write_matrix(sheet: Worksheet, names: List[str], matrix: List[List[float]]):
+        """Writes a travel matrix to the sheet a row at a time, below and to the right of the location names."""
+        width = len(matrix[0])
+        header_cells = next(sheet.iter_rows(min_row=1, max_row=1, min_col=2, max_col=width + 1))
+        for cell, name in zip(header_cells, names):
+            cell.value = name
+
+        matrix_cells = sheet.iter_rows(min_row=2, max_row=len(matrix) + 1, max_col=width + 1)
+        for row, (cells, matrix_row) in enumerate(zip(matrix_cells, matrix)):
+            values = [names[row], *matrix_row]
+            # On the diagonal, set the travel to be equal to going to the depot and back
+            values[row + 1] = matrix_row[0] + matrix[0][row]
+            for cell, value in zip(cells, values):
+                cell.value = value
+
     @staticmethod
     def update_matrices(filename: str, sheetname: str):
         """Reads in the location data from the appropriate sheet, requests the travel matrix from Bing, then saves
@@ -375,6 +453,8 @@ class ArcLocation:
 
 
 class ArcStop:
+    __slots__ = ("location", "delivered")
+
     def __init__(self, location: ArcLocation, delivered: int):
         self.location = location
         self.delivered = delivered
@@ -383,19 +463,44 @@ class ArcStop:
 
 
 class ArcRoute:
-    """Stores information from the archive about a route that a vehicle travelled."""
+    """Stores information from the archive about a route that a vehicle travelled. The stops should only be changed
+    through the route's methods, so that the cached list of stops is kept up to date."""
+    __slots__ = ("code", "vehicle", "stops", "_stop_list")
 
     def __init__(self, code: int, vehicle: ArcVehicle):
         self.code = code
         self.vehicle = vehicle
         self.stops: List[ArcStop] = []
+        self._stop_list: Optional[List[Tuple[int, int]]] = None
 
-    def __eq__(self, other):
-        if isinstance(other, ArcRoute):
-            return other.code == self.code
-        if isinstance(other, int):
-            return other == self.code
-        return False
+    def add_stop(self, location: ArcLocation, delivered: int):
+        """Adds a stop to the end of the route. If the last stop was at the same location, the delivery is added to
+        it instead."""
+        if self.stops and self.stops[-1].location == location:
+            self.stops[-1].delivered += delivered
+        else:
+            self.stops.append(ArcStop(location, delivered))
+        self._stop_list = None
+
+    def reverse_stops(self):
+        """Reverses the order of the stops."""
+        self.stops.reverse()
+        self._stop_list = None
+
+    def reduce_deliveries(self, reductions: List[int]):
+        """Reduces the amount delivered on each stop, and the demand of its location, by the matching reduction."""
+        for stop, reduction in zip(self.stops, reductions):
+            stop.delivered -= reduction
+            stop.location.demand -= reduction
+        self._stop_list = None
+
+    def stop_list(self) -> List[Tuple[int, int]]:
+        """Returns the location index and amount delivered of each stop that makes a delivery. The list is cached
+        until the stops are changed, so it must not be modified."""
+        if self._stop_list is None:
+            self._stop_list = [(stop.location.data_index, stop.delivered) for stop in self.stops
+                               if stop.delivered != 0]
+        return self._stop_list
 
     def to_list(self) -> Tuple[int, List[Tuple[int, int]]]:
         """Returns a tuple containing list representing the route that can be used"""
@@ -403,79 +508,72 @@ class ArcRoute:
         return self.vehicle.vehicle_type.data_index, route
 
     @staticmethod
-    def find_route(route_code: str, routes: Dict[int, List["ArcRoute"]]) -> Optional["ArcRoute"]:
-        """Searches the list of routes for one that contains the given route code."""
-        for vehicle_type_index, tour in routes.items():
-            count = tour.count(route_code)
-            if count > 0:
-                return tour[tour.index(route_code)]
-            else:
-                return None
-
-    @staticmethod
-    def read_archive(filename: str, locations: List[ArcLocation], vehicles: List[ArcVehicle],
-                     vehicle_types: List[ArcVehicleType]) -> Dict[int, List["ArcRoute"]]:
-        """Reads in the delivery archive and sums up the demand per location and creating route lists."""
-        workbook = load_workbook(filename=filename, read_only=True, data_only=True)
-        deliveries_sheet = workbook["Deliveries"]
-        routes: Dict[int, List[ArcRoute]] = {}
-        row = 2
-        code = 0
-        route: Optional[ArcRoute] = None
-        while deliveries_sheet[f"A{row}"].value:
-            # Get the route code
-            code = deliveries_sheet[f"D{row}"].value
-
-            # If the route code does not match, then the route is probably finished
-            if route is None or code != route.code:
+    def read_archive(filename: str, store_index: Dict[int, ArcLocation], vehicle_types: List[ArcVehicleType],
+                     vehicle_index: Optional[Dict[str, ArcVehicle]] = None,
+                     workbook: Optional[Workbook] = None) -> Dict[int, List["ArcRoute"]]:
+        """Reads in the delivery archive and sums up the demand per location and creating route lists. The route's
+        vehicles are only looked up in the fleet if a vehicle index is given."""
+        with open_read_only(filename, workbook, data_only=True) as workbook:
+            # The column bound keeps every row padded to the last column that is used
+            deliveries_sheet = _get_sheet(workbook, "Deliveries")
+            routes: Dict[int, List[ArcRoute]] = {}
+            # The helpers are used on every line, so look them up once
+            find_location = ArcLocation.find_location
+            read_pallets = ArcRoute._read_pallets
+            rows = takewhile(lambda row: row[0], deliveries_sheet.iter_rows(min_row=2, max_col=16, values_only=True))
+            # Consecutive lines with the same route code (column D) are all part of the same route. If the route code
+            # changes, then the route is finished, so a new route is started with the vehicle from its first line
+            # (J: horse, K: trailer, P: carried).
+            for code, route_rows in groupby(rows, key=itemgetter(3)):
+                route_rows = list(route_rows)
+                first_row = route_rows[0]
+                route = ArcRoute._start_route(code, first_row[9], first_row[10], first_row[15], vehicle_types,
+                                              vehicle_index)
+
+                for row in route_rows:
+                    # Only some of the remaining columns are needed (B: store, M-O: demands)
+                    store_code = row[1]
+                    dry, perish, pick_by_line = row[12:15]
+
+                    # Find the location
+                    location = find_location(store_code, store_index)
+
+                    if location:
+                        # Read in the demands, defaulting to 0 if they are blank or have "C/S"
+                        dry_demand = read_pallets(dry)
+                        perish_demand = read_pallets(perish)
+                        pick_by_line_demand = read_pallets(pick_by_line)
+
+                        # if dry_demand < 0 or perish_demand < 0 or pick_by_line_demand < 0:
+                        #     raise ValueError("Negative demand.")
+                        demand = dry_demand + perish_demand + pick_by_line_demand
+
+                        # If there is no demand for the stop, set it to one so that it isn't ignored.
+                        if demand == 0:
+                            demand = 1
+
+                        # Add the demand to the location's overall demand
+                        location.demand += demand
+                        # And set the amount delivered on this stop in the route
+                        # route.stops.append(ArcStop(location, demand))
+                        # If the previous stop was at the same location, this merges them into one stop.
+                        route.add_stop(location, demand)
+
+                # The routes are in reverse order in the archives, so the stops must be reversed
+                route.reverse_stops()
                 ArcRoute._finish_route(route, routes)
-                route = ArcRoute._start_route(code, row, deliveries_sheet, vehicles, vehicle_types)
-
-            # Find the location
-            location = ArcLocation.find_location(deliveries_sheet[f"B{row}"].value, locations)
-
-            if location:
-                # Read in the demands, defaulting to 0 if they are blank or have "C/S"
-                try:
-                    dry_demand = int(deliveries_sheet[f"M{row}"].value)
-                except (ValueError, TypeError):
-                    dry_demand = 0
-                try:
-                    perish_demand = int(deliveries_sheet[f"N{row}"].value)
-                except (ValueError, TypeError):
-                    perish_demand = 0
-                try:
-                    pick_by_line_demand = int(deliveries_sheet[f"O{row}"].value)
-                except (ValueError, TypeError):
-                    pick_by_line_demand = 0
-
-                # if dry_demand < 0 or perish_demand < 0 or pick_by_line_demand < 0:
-                #     raise ValueError("Negative demand.")
-                demand = dry_demand + perish_demand + pick_by_line_demand
-
-                # If there is no demand for the stop, set it to one so that it isn't ignored.
-                if demand == 0:
-                    demand = 1
-
-                # Add the demand to the location's overall demand
-                location.demand += demand
-                # And set the amount delivered on this stop in the route
-                # route.stops.append(ArcStop(location, demand))
-                # Check whether the previous stop was at the same location. If so, merge them into one stop.
-                if len(route.stops) > 0 and route.stops[0].location == location:
-                    route.stops[0].delivered += demand
-                else:
-                    # Must be inserted at the start of the route, because the routes are in reverse order in the
-                    # archives
-                    route.stops.insert(0, ArcStop(location, demand))
-
-            row += 1
-
-        if code > 0:
-            ArcRoute._finish_route(route, routes)
 
         return routes
 
+    @staticmethod
+    def _read_pallets(value: Union[int, float, str, None]) -> int:
+        """Reads a number of pallets from an archive cell, which is usually a number but can be blank or "C/S"."""
+        if isinstance(value, (int, float)):
+            return int(value)
+        if isinstance(value, str) and _PALLETS_PATTERN.fullmatch(value):
+            return int(value)
+        return 0
+
     @staticmethod
     def _finish_route(route: Optional["ArcRoute"], routes: Dict[int, List["ArcRoute"]]):
         """Makes sure that the total pallets carried on a route do not exceed the vehicle type capacity, then adds the
@@ -485,98 +583,102 @@ class ArcRoute:
             # make this work by consolidating pallets, reducing the actual number of pallets used. This isn't
             # handled by the algorithm, so - for the sake of fairness - any routes that have more pallets
             # than their vehicle's capacity will have their demand reduced.
-            total_delivered = sum([stop.delivered for stop in route.stops])
-            stop_ind = 0
-            while total_delivered > route.vehicle.vehicle_type.capacity:
-                # Cycle through the stops, removing one demand from each at a time until total demand is
-                # acceptable
-                if route.stops[stop_ind].delivered > 1:
-                    # Don't decrement the amount delivered to stops that have no more than 1 pallet delivered.
-                    route.stops[stop_ind].delivered -= 1
-                    route.stops[stop_ind].location.demand -= 1
-                    total_delivered -= 1
-                stop_ind = (stop_ind + 1) % len(route.stops)
-            if not routes.get(route.vehicle.vehicle_type.data_index):
-                routes[route.vehicle.vehicle_type.data_index] = []
-            routes[route.vehicle.vehicle_type.data_index].append(route)
+            vehicle_type = route.vehicle.vehicle_type
+            delivered = [stop.delivered for stop in route.stops]
+            excess = sum(delivered) - vehicle_type.capacity
+            if excess > 0:
+                route.reduce_deliveries(ArcRoute._spread_excess(delivered, excess))
+            routes.setdefault(vehicle_type.data_index, []).append(route)
+
+    @staticmethod
+    def _spread_excess(delivered: List[int], excess: int) -> List[int]:
+        """Works out how much to reduce each delivery by to remove the excess pallets. This gives the same result as
+        cycling through the stops, removing one pallet from each at a time until the excess is gone, without
+        decrementing the amount delivered to stops that have no more than 1 pallet delivered."""
+        headroom = [amount - 1 for amount in delivered]
+        # Find how many full cycles can be made, jumping ahead until one of the stops runs out of headroom
+        cycles = 0
+        eligible = [index for index, room in enumerate(headroom) if room > cycles]
+        while eligible and excess >= len(eligible):
+            step = min(min(headroom[index] for index in eligible) - cycles, excess // len(eligible))
+            cycles += step
+            excess -= step * len(eligible)
+            eligible = [index for index, room in enumerate(headroom) if room > cycles]
+
+        reductions = [max(min(room, cycles), 0) for room in headroom]
+        # The remaining excess is less than one cycle, so it is taken from the first stops in the cycle
+        for index in eligible[:excess]:
+            reductions[index] += 1
+        return reductions
 
     @staticmethod
-    def _start_route(code: int, row: int, deliveries_sheet: Worksheet, vehicles: List[ArcVehicle],
-                     vehicle_types: List[ArcVehicleType]) -> "ArcRoute":
+    def _start_route(code: int, horse: str, trailer: str, carried: int, vehicle_types: List[ArcVehicleType],
+                     vehicle_index: Optional[Dict[str, ArcVehicle]] = None) -> "ArcRoute":
         """Creates a new route after finding the appropriate vehicle type to use."""
-        # Check if the current route code matches anything already found
-        # (just in case one vehicle's lines are spread out)
-        # route = find_route(code, routes)
-        # If not, create a new route
-        # if not route:
-        vehicle = ArcVehicle.find_vehicle(horse=deliveries_sheet[f"J{row}"].value,
-                                          trailer=deliveries_sheet[f"K{row}"].value,
-                                          carried=deliveries_sheet[f"P{row}"].value,
-                                          vehicles=vehicles, vehicle_types=vehicle_types)
+        vehicle = ArcVehicle.find_vehicle(horse=horse, trailer=trailer, carried=carried, vehicle_types=vehicle_types,
+                                          vehicle_index=vehicle_index)
         # if vehicle:
         route = ArcRoute(code=code, vehicle=vehicle)
-        route.vehicle.vehicle_type.vehicles_used += 1
+        vehicle.vehicle_type.vehicles_used += 1
 
         return route
 
     @staticmethod
     def convert_routes_to_lists(routes: Dict[int, List["ArcRoute"]]) -> Dict[int, List[List[Tuple[int, int]]]]:
-        """Converts a dict of routes to lists of tuples."""
+        """Converts a dict of routes to lists of tuples, leaving out stops that don't make any deliveries. Only the
+        routes that have changed since they were last converted need to be walked."""
         lists: Dict[int, List[List[Tuple[int, int]]]] = {}
         for vehicle_type_index, tour in routes.items():
-            lists[vehicle_type_index] = [[(stop.location.data_index, stop.delivered) for stop in route.stops] for route
-                                         in
-                                         tour]
+            lists[vehicle_type_index] = [route.stop_list() for route in tour]
 
         return lists
 
     @staticmethod
-    def save_archive_routes(routes: Dict[int, List["ArcRoute"]], filename: str):
-        """Save the archive routes to the workbook in JSON format."""
-        workbook = load_workbook(filename)
-        workbook["Archive Routes"]["A1"].value = json.dumps(ArcRoute.convert_routes_to_lists(routes))
-        workbook.save(filename)
+    def save_archive_routes(routes: Dict[int, List["ArcRoute"]], filename: str, workbook: Optional[Workbook] = None):
+        """Save the archive routes to the workbook in JSON format. If an open workbook is given, the routes are added
+        to it and saving is left to the caller."""
+        should_save = workbook is None
+        if workbook is None:
+            workbook = load_workbook(filename)
+        # Use compact separators, as the whole routes dict is stored in a single cell
+        workbook["Archive Routes"]["A1"].value = json.dumps(ArcRoute.convert_routes_to_lists(routes),
+                                                            separators=(",", ":"))
+        if should_save:
+            workbook.save(filename)
 
     @staticmethod
-    def load_json_routes(filename: str, sheetname: str = "Archive Routes", cell: str = "A1") -> Dict[
-        int, List[List[List[int]]]]:
+    def load_json_routes(filename: str, sheetname: str = "Archive Routes", cell: str = "A1",
+                         workbook: Optional[Workbook] = None) -> Dict[int, List[List[List[int]]]]:
         """Load the archive routes from the workbook in JSON format."""
-        workbook = load_workbook(filename, read_only=True)
-        # Must convert the string keys to integers
-        str_dict: Dict[str, List[List[List[int]]]] = json.loads(workbook[sheetname][cell].value)
+        with open_read_only(filename, workbook) as workbook:
+            # Must convert the string keys to integers
+            str_dict: Dict[str, List[List[List[int]]]] = json.loads(workbook[sheetname][cell].value)
         int_dict: Dict[int, List[List[List[int]]]] = {}
         for vehicle_type, tour in str_dict.items():
-            # Also remove stops that don't make any deliveries:
-            for route in tour:
-                index = 0
-                while index < len(route):
-                    if route[index][1] == 0:
-                        route.pop(index)
-                    else:
-                        index += 1
-
-            int_dict[int(vehicle_type)] = tour
+            # Also remove stops that don't make any deliveries
+            int_dict[int(vehicle_type)] = [[stop for stop in route if stop[1] != 0] for route in tour]
         return int_dict
 
 
 def save_input_data(locations: List[ArcLocation], vehicle_types: List[ArcVehicleType],
-                    filename: str, anonymised: bool = False):
-    """Saves the information for all locations and vehicle types for the day imported."""
-    workbook = load_workbook(filename)
+                    filename: str, anonymised: bool = False, workbook: Optional[Workbook] = None):
+    """Saves the information for all locations and vehicle types for the day imported. If an open workbook is given,
+    the information is added to it and saving is left to the caller."""
+    should_save = workbook is None
+    if workbook is None:
+        workbook = load_workbook(filename)
 
     # Add the locations
     locations_sheet: Worksheet = workbook["Locations"]
-    for index, location in enumerate(locations):
+    location_rows = locations_sheet.iter_rows(min_row=2, max_row=len(locations) + 1, max_col=7)
+    for cells, location in zip(location_rows, locations):
         if anonymised:
-            locations_sheet[f"A{index + 2}"].value = location.anonymous_name
+            cells[0].value = location.anonymous_name
         else:
-            locations_sheet[f"A{index + 2}"].value = location.name
-            locations_sheet[f"B{index + 2}"].value = location.latitude
-            locations_sheet[f"C{index + 2}"].value = location.longitude
-        locations_sheet[f"D{index + 2}"].value = location.demand
-        locations_sheet[f"E{index + 2}"].value = 0
-        locations_sheet[f"F{index + 2}"].value = 24
-        locations_sheet[f"G{index + 2}"].value = location.average_offload_time
+            for cell, value in zip(cells, (location.name, location.latitude, location.longitude)):
+                cell.value = value
+        for cell, value in zip(cells[3:], (location.demand, 0, 24, location.average_offload_time)):
+            cell.value = value
 
     # Add the location distances and times
     # distances_sheet: Worksheet = workbook["Distances"]
@@ -614,22 +716,32 @@ def save_input_data(locations: List[ArcLocation], vehicle_types: List[ArcVehicle
     for vehicle_type in vehicle_types:
         vehicle_types_sheet[f"F{vehicle_type.data_index + 2}"].value = vehicle_type.vehicles_used
 
-    workbook.save(filename)
+    if should_save:
+        workbook.save(filename)
 
 
-def convert_archive(archive_filename: str, data_filename: str = "Model Data.xlsx", anonymised: bool = False):
-    """Reads in the demand, location, vehicle, and route data from the archive and then saves it."""
+def convert_archive(archive_filename: str, data_filename: str = "Model Data.xlsx", anonymised: bool = False,
+                    match_fleet: bool = False):
+    """Reads in the demand, location, vehicle, and route data from the archive and then saves it. If match_fleet is
+    set, each route's vehicle is looked up in the fleet by its horse or trailer code before falling back to the
+    vehicle type with the closest capacity. This changes the results from those of earlier conversions."""
+    # Open the model data workbook once for reading the vehicle types and for both sets of changes, which are then
+    # saved together
+    data_workbook = load_workbook(data_filename)
     locations = ArcLocation.read_locations(filename="SPAR Locations and Schedule.xlsx",
                                            sheetname="Store Locations")
     vehicle_types, vehicles = ArcVehicle.read_vehicles(types_file=data_filename, types_sheet="Vehicle Types",
-                                                       vehicles_file="Spar Fleet.xlsx", vehicles_sheet="trucks")
-    routes = ArcRoute.read_archive(archive_filename, locations, vehicles, vehicle_types)
-    save_input_data(locations, vehicle_types, filename=data_filename, anonymised=anonymised)
-    ArcRoute.save_archive_routes(routes, data_filename)
-    # if anonymised:
-    #     location_names = [location.anonymous_name for location in locations]
-    # else:
-    #     location_names = [location.name for location in locations]
+                                                       vehicles_file="Spar Fleet.xlsx", vehicles_sheet="trucks",
+                                                       types_workbook=data_workbook)
+    # Index the locations and vehicles once, so that each archive row only needs a dict lookup
+    store_index = ArcLocation.build_store_index(locations)
+    # The saved archive routes and vehicles used have always been found from the closest capacity to the load
+    # carried, so the fleet is only searched if asked for
+    vehicle_index = ArcVehicle.build_vehicle_index(vehicles) if match_fleet else None
+    routes = ArcRoute.read_archive(archive_filename, store_index, vehicle_types, vehicle_index=vehicle_index)
+    save_input_data(locations, vehicle_types, filename=data_filename, anonymised=anonymised, workbook=data_workbook)
+    ArcRoute.save_archive_routes(routes, data_filename, workbook=data_workbook)
+    data_workbook.save(data_filename)
 
 
 def verify_routes_demand(filename: str):
@@ -653,18 +765,14 @@ def verify_routes_demand(filename: str):
                 serviced_demands[customer] += serviced_demand
 
     # Record the data to the workbook
-    workbook = load_workbook(filename, data_only=True)
+    # Not data_only, as saving would replace the formulas in the workbook with their cached values
+    workbook = load_workbook(filename)
     sheet = workbook["Locations"]
-    row = 2
-    while sheet[f"A{row}"].value:
-        if serviced_demands.get(row - 2):
-            # If there is a value for the customer of this row, save it
-            sheet[f"I{row}"].value = serviced_demands[row - 2]
-        else:
-            # Otherwise, set the row's value to zero
-            sheet[f"I{row}"].value = 0
-
-        row += 1
+    for customer, cells in enumerate(sheet.iter_rows(min_row=2, max_col=9)):
+        if not cells[0].value:
+            break
+        # If there is a value for the customer of this row, save it. Otherwise, set the row's value to zero.
+        cells[8].value = serviced_demands.get(customer, 0)
 
     # Save the changes
     workbook.save(filename)
@@ -673,45 +781,30 @@ def verify_routes_demand(filename: str):
 def import_data(filename: str = "Model Data.xlsx") -> Data:
     """Reads in the demand, location, and vehicle data to create input data for the algorithm.
     Also generates the routes from the archived data."""
-    data_workbook = load_workbook(filename=filename, read_only=True, data_only=True)
-
-    # Read in the location information
-    location_sheet = data_workbook["Locations"]
-    locations: List[str] = []
-    demand: List[int] = []
-    window_start: List[float] = []
-    window_end: List[float] = []
-    average_unload_time: List[float] = []
-    row = 2
-    while location_sheet[f"A{row}"].value:
-        locations.append(location_sheet[f"A{row}"].value)
-        demand.append(int(location_sheet[f"D{row}"].value))
-        window_start.append(location_sheet[f"E{row}"].value)
-        window_end.append(location_sheet[f"F{row}"].value)
-        average_unload_time.append(location_sheet[f"G{row}"].value)
-
-        row += 1
-
-    # Read in the vehicle data
-    vehicle_sheet = data_workbook["Vehicle Types"]
-    vehicle_types: List[str] = []
-    distance_cost: List[float] = []
-    time_cost: List[float] = []
-    pallet_capacity: List[int] = []
-    available_vehicles: List[int] = []
-    hired_cost_multiplier: List[float] = []
-    row = 2
-    while vehicle_sheet[f"A{row}"].value:
-        vehicle_types.append(vehicle_sheet[f"A{row}"].value)
-        distance_cost.append(vehicle_sheet[f"B{row}"].value)
-        time_cost.append(vehicle_sheet[f"C{row}"].value)
-        pallet_capacity.append(int(vehicle_sheet[f"D{row}"].value))
-        available_vehicles.append(int(vehicle_sheet[f"E{row}"].value))
-        hired_cost_multiplier.append(vehicle_sheet[f"G{row}"].value)
-
-        row += 1
-
-    distances, times = ArcLocation.import_matrix_input_data(filename=filename)
+    with open_read_only(filename, data_only=True) as data_workbook:
+        # Read in the location information
+        location_sheet = _get_sheet(data_workbook, "Locations")
+        # Take all the rows in one pass, then split them into the columns the algorithm needs
+        location_rows = list(takewhile(lambda row: row[0],
+                                       location_sheet.iter_rows(min_row=2, max_col=7, values_only=True)))
+        locations: List[str] = [row[0] for row in location_rows]
+        demand: List[int] = [int(row[3]) for row in location_rows]
+        window_start: List[float] = [row[4] for row in location_rows]
+        window_end: List[float] = [row[5] for row in location_rows]
+        average_unload_time: List[float] = [row[6] for row in location_rows]
+
+        # Read in the vehicle data
+        vehicle_sheet = _get_sheet(data_workbook, "Vehicle Types")
+        vehicle_rows = list(takewhile(lambda row: row[0],
+                                      vehicle_sheet.iter_rows(min_row=2, max_col=7, values_only=True)))
+        vehicle_types: List[str] = [row[0] for row in vehicle_rows]
+        distance_cost: List[float] = [row[1] for row in vehicle_rows]
+        time_cost: List[float] = [row[2] for row in vehicle_rows]
+        pallet_capacity: List[int] = [int(row[3]) for row in vehicle_rows]
+        available_vehicles: List[int] = [int(row[4]) for row in vehicle_rows]
+        hired_cost_multiplier: List[float] = [row[6] for row in vehicle_rows]
+
+        distances, times = ArcLocation.import_matrix_input_data(filename=filename, workbook=data_workbook)
 
     archive_data = Data(locations=locations, demand=demand, window_start=window_start, window_end=window_end,
                         average_unload_time=average_unload_time, distances=distances, times=times,
@@ -1,22 +1,32 @@
 import json
+import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from math import hypot
 from time import perf_counter
-from typing import List, Dict, Tuple, Union, Any
+from typing import List, Dict, Tuple, Union, Any, Optional
 
-from openpyxl import load_workbook
+from openpyxl import Workbook, load_workbook
 
 from data_objects import Location, VehicleType, data_globals
 from individual import Individual
 from main import Runner
 from model import run_settings
 from settings import Data
-from validation import ArcRoute
+from validation import ArcRoute, open_read_only
 
+# Patterns for the fixed format lines of the mathematical output
+_CUSTOMER_PATTERN = re.compile(r"Customer (\S+) has (\d+) pallets demand and window (\d+)-(\d+) "
+                               r"at \(([^,]+), ([^)]+)\) and average unload time (\S+)")
+_VEHICLE_PATTERN = re.compile(r"Vehicle (\S+) is a (.+?) with capacity (\d+), "
+                              r"distance cost ([^,]+), and time cost (\S+)")
+_MOVE_PATTERN = re.compile(r"Vehicle (\S+) travels from (\S+) to (\S+) to deliver (\S+) pallets")
 
-def get_exact_output_data_from_sheet(row: int) -> str:
+
+def get_exact_output_data_from_sheet(row: int, workbook: Optional[Workbook] = None) -> str:
     """Gets the output text file data from a certain row on the solve times summary sheet."""
-    workbook = load_workbook(filename="Solve Times Summary.xlsx", read_only=True)
-    run_data_sheet = workbook["Run Data"]
-    return run_data_sheet[f"H{row}"].value
+    with open_read_only("Solve Times Summary.xlsx", workbook) as workbook:
+        return workbook["Run Data"][f"H{row}"].value
 
 
 def extract_data_from_output(math_output: str) -> Tuple[Data, Dict[int, List[List[Union[Tuple[int, int], List[int]]]]]]:
@@ -32,22 +42,21 @@ def extract_data_from_output(math_output: str) -> Tuple[Data, Dict[int, List[Lis
     window_ends: List[int] = [24]
     average_unload_time: List[float] = [0.0]
     coords: List[Tuple[float, float]] = [(0, 0)]
-    while output_lines[current_line] and output_lines[current_line].count("Customer ") == 1:
-        words = output_lines[current_line].split()
-        # The fixed pattern of the output means the same words will always be in the same place
-        # print([f"{num}: {word}" for num, word in enumerate(words)])
-        # Example line: ['0: Customer', '1: 1', '2: has', '3: 5', '4: pallets', '5: demand', '6: and', '7: window',
-        # '8: 0-24', '9: at', '10: (-5.625091957,', '11: 77.494351875)', '12: and', '13: average', '14: unload',
-        # '15: time', '16: 0.120062083']
-        locations.append(words[1])
-        demands.append(int(words[3]))
-        window = words[8].split("-")
-        window_starts.append(int(window[0]))
-        window_ends.append(int(window[1]))
-        average_unload_time.append(float(words[16]))
-        coords.append((float(words[10][1:-1]), float(words[11][:-1])))
+    # The fixed pattern of the output means each line can be matched as a whole
+    # Example line: Customer 1 has 5 pallets demand and window 0-24 at (-5.625091957, 77.494351875) and average unload
+    # time 0.120062083
+    match = _CUSTOMER_PATTERN.search(output_lines[current_line])
+    while match:
+        name, demand, window_start, window_end, x, y, unload_time = match.groups()
+        locations.append(name)
+        demands.append(int(demand))
+        window_starts.append(int(window_start))
+        window_ends.append(int(window_end))
+        average_unload_time.append(float(unload_time))
+        coords.append((float(x), float(y)))
 
         current_line += 1
+        match = _CUSTOMER_PATTERN.search(output_lines[current_line])
 
     # Add the depot return
     locations.append("DepotReturn")
@@ -58,55 +67,45 @@ def extract_data_from_output(math_output: str) -> Tuple[Data, Dict[int, List[Lis
     coords.append((0, 0))
 
     # Generate distances and times from Euclidean distances between the coordinates.
-    distances = []
-    times = []
-    for index, from_loc in enumerate(coords):
-        distances.append([])
-        times.append([])
-        for to_loc in coords:
-            from_x, from_y = from_loc
-            to_x, to_y = to_loc
-            distance = ((from_x - to_x) ** 2 + (from_y - to_y) ** 2) ** 0.5
-            distances[index].append(distance)
-            times[index].append(distance / 80)
+    distances: List[List[float]] = [[hypot(from_x - to_x, from_y - to_y) for to_x, to_y in coords]
+                                    for from_x, from_y in coords]
+    times: List[List[float]] = [[distance / 80 for distance in distance_row] for distance_row in distances]
 
     # Loop through the vehicles to find information about the vehicle types.
     vehicle_name_types: Dict[str, int] = {}
+    # Keep track of the index of each type found, so that the list of types doesn't need to be searched
+    type_indices: Dict[str, int] = {}
     vehicle_types: List[str] = []
     distance_cost: List[float] = []
     time_cost: List[float] = []
     pallet_capacity: List[int] = []
     available_vehicles: List[int] = []
-    while output_lines[current_line] and output_lines[current_line].count("Vehicle ") == 1:
-        # print([f"{num}: {word}" for num, word in enumerate(words)])
-        # ['0: Vehicle', '1: SP1', '2: is', '3: a', '4: 11', '5: metre', '6: with', '7: capacity', '8: 30,',
-        # '9: distance', '10: cost', '11: 0.796243095,', '12: and', '13: time', '14: cost', '15: 10.888817567']
-        # Find the vehicle type name
-        line = output_lines[current_line]
-        after_name = line.index(" with capacity")
-        words: List[str] = line[:after_name].split()
-        vehicle_type = " ".join(words[4:])
-        vehicle_name = words[1]
+    # Example line: Vehicle SP1 is a 11 metre with capacity 30, distance cost 0.796243095, and time cost 10.888817567
+    match = _VEHICLE_PATTERN.search(output_lines[current_line])
+    while match:
+        vehicle_name, vehicle_type, capacity, vehicle_distance_cost, vehicle_time_cost = match.groups()
 
         # Check if this vehicle type was already found
-        if vehicle_types.count(vehicle_type) == 0:
+        type_index = type_indices.get(vehicle_type)
+        if type_index is None:
             # Add the type to the list of types
+            type_index = len(vehicle_types)
+            type_indices[vehicle_type] = type_index
             vehicle_types.append(vehicle_type)
             available_vehicles.append(1)
             # Get the properties of the vehicle
-            words = line[after_name + 1:].split()
-            pallet_capacity.append(int(words[2][:-1]))
-            distance_cost.append(float(words[5][:-1]))
-            time_cost.append(float(words[9]))
+            pallet_capacity.append(int(capacity))
+            distance_cost.append(float(vehicle_distance_cost))
+            time_cost.append(float(vehicle_time_cost))
         else:
             # Increment the number of available vehicles of this type
-            index = vehicle_types.index(vehicle_type)
-            available_vehicles[index] += 1
+            available_vehicles[type_index] += 1
 
         # Add the index of this vehicle to the dict that will later be used to identify the types of vehicles
-        vehicle_name_types[vehicle_name] = vehicle_types.index(vehicle_type)
+        vehicle_name_types[vehicle_name] = type_index
 
         current_line += 1
+        match = _VEHICLE_PATTERN.search(output_lines[current_line])
 
     run_data = Data(locations=locations, vehicle_types=vehicle_types, distance_cost=distance_cost, time_cost=time_cost,
                     pallet_capacity=pallet_capacity, available_vehicles=available_vehicles, demand=demands,
@@ -118,19 +117,16 @@ def extract_data_from_output(math_output: str) -> Tuple[Data, Dict[int, List[Lis
 
     # Iterate across solution lines use dictionary structure to compile a list of which vehicles travel where and to 
     # deliver how much, before compiling this into routes
-    all_moves: Dict[str, Dict[str, Dict[str, str]]] = {}
-    while output_lines[current_line] and output_lines[current_line].count("Vehicle ") == 1:
-        words = output_lines[current_line].split()
-        # print([f"{num}: {word}" for num, word in enumerate(words)])
-        # ['0: Vehicle', '1: SP1', '2: travels', '3: from', '4: Depot', '5: to', '6: 7', '7: to', '8: deliver', '9: 5',
-        # '10: pallets.', '11: Expected', '12: unload', '13: start', '14: time', '15: is', '16: 5.084413751']
-        vehicle = words[1]
-        if not all_moves.get(vehicle):
-            all_moves[vehicle] = {}
-        from_loc = words[4]
-        all_moves[vehicle][from_loc] = {"to": words[6], "load": words[9]}
+    # Each vehicle's moves map where it travels from to where it travels to and the load it delivers there
+    all_moves: Dict[str, Dict[str, Tuple[str, int]]] = {}
+    # Example line: Vehicle SP1 travels from Depot to 7 to deliver 5 pallets. Expected unload start time is 5.084413751
+    match = _MOVE_PATTERN.search(output_lines[current_line])
+    while match:
+        vehicle, from_loc, to_loc, load = match.groups()
+        all_moves.setdefault(vehicle, {})[from_loc] = (to_loc, int(load))
 
         current_line += 1
+        match = _MOVE_PATTERN.search(output_lines[current_line])
 
     # Prepare the mathematical solution dict
     math_solution: Dict[int, List[List[Tuple[int, int]]]] = {}
@@ -143,11 +139,11 @@ def extract_data_from_output(math_output: str) -> Tuple[Data, Dict[int, List[Lis
         # Find the type index for this vehicle
         type_index = vehicle_name_types[vehicle]
         route = []
-        # Add the moves to the route
-        move = vehicle_moves["Depot"]
-        while move["to"] != "DepotReturn":
-            route.append((int(move["to"]), int(move["load"])))
-            move = vehicle_moves[move["to"]]
+        # Follow the moves from the depot, adding each stop to the route until the vehicle returns
+        to_loc, load = vehicle_moves["Depot"]
+        while to_loc != "DepotReturn":
+            route.append((int(to_loc), load))
+            to_loc, load = vehicle_moves[to_loc]
 
         # Add the route to the tour
         math_solution[type_index].append(route)
@@ -158,10 +154,14 @@ def extract_data_from_output(math_output: str) -> Tuple[Data, Dict[int, List[Lis
 def write_data_to_sheet(row: int = None, exact_routes: Dict[int, List[List[List[int]]]] = None,
                         exact_objective: float = None, meta_routes: Dict[int, List[List[List[int]]]] = None,
                         pretty_meta_routes: str = None, meta_time: float = None, meta_objective: float = None,
-                        simple_exact_objective: float = None, simple_meta_objective: float = None):
-    """Writes metaheuristic output data to the solve times summary sheet."""
+                        simple_exact_objective: float = None, simple_meta_objective: float = None,
+                        workbook: Optional[Workbook] = None):
+    """Writes metaheuristic output data to the solve times summary sheet. If an open workbook is given, the data is
+    added to it and saving is left to the caller."""
     filename = "Solve Times Summary.xlsx"
-    workbook = load_workbook(filename=filename)
+    should_save = workbook is None
+    if workbook is None:
+        workbook = load_workbook(filename=filename)
     run_data_sheet = workbook["Run Data"]
 
     if exact_routes:
@@ -181,7 +181,8 @@ def write_data_to_sheet(row: int = None, exact_routes: Dict[int, List[List[List[
     if simple_meta_objective:
         run_data_sheet[f"V{row}"].value = simple_meta_objective
 
-    workbook.save(filename)
+    if should_save:
+        workbook.save(filename)
 
 
 def apply_verification_settings(run_data: Data):
@@ -195,7 +196,9 @@ def apply_verification_settings(run_data: Data):
 def evaluate_solution_simply(solution: Dict[int, List[List[Union[Tuple[int, int], List[int]]]]]) -> float:
     """Evaluates a solution purely based on the cost of distance and time spent travelling."""
     # Grab some variables from the settings so they don't need to be repeatedly retrieved
-    depot = data_globals.DEPOT
+    depot_index = data_globals.DEPOT.data_index
+    distances = run_settings.RUN_DATA.distances
+    times = run_settings.RUN_DATA.times
 
     # Initialise the overall cost value
     cost: float = 0
@@ -208,22 +211,20 @@ def evaluate_solution_simply(solution: Dict[int, List[List[Union[Tuple[int, int]
 
         # Loop through each route in the tour
         for route in tour:
-            # The distance from the first stop to the depot must be added
-            previous_stop = depot
-            # Loop through each stop in the route
-            for stop_index, stop_data in enumerate(route):
-                stop = Location(stop_data[0], stop_data[1])
-
-                # Add the distance between this and the previous stop
-                distance += previous_stop.travel_distances[stop.data_index]
-                time += previous_stop.travel_times[stop.data_index]
-
-                # The distance from the last stop to the depot must be added
-                if stop_index == len(route) - 1:
-                    distance += stop.travel_distances[depot.data_index]
-                    time += stop.travel_times[depot.data_index]
-
-                previous_stop = stop
+            if not route:
+                continue
+            # The distance from the depot to the first stop must be added
+            previous_index = depot_index
+            # Loop through each stop in the route, adding the travel between it and the previous stop
+            for stop_data in route:
+                stop_index = stop_data[0]
+                distance += distances[previous_index][stop_index]
+                time += times[previous_index][stop_index]
+                previous_index = stop_index
+
+            # The distance from the last stop to the depot must be added
+            distance += distances[previous_index][depot_index]
+            time += times[previous_index][depot_index]
 
         cost += (vehicle_type.distance_cost * distance) + (vehicle_type.time_cost * time)
 
@@ -391,6 +392,29 @@ def check_all_true(to_check: Dict[Any, bool]) -> bool:
     return all(value for value in to_check.values())
 
 
+def verify_row(row: int, text_data: str) -> Dict[str, Any]:
+    """Runs the metaheuristic on the exact data of a row and evaluates the exact solution. Returns the results as the
+    arguments for write_data_to_sheet, so that rows can be solved in separate processes."""
+    print(f"\nVerifying row {row}\n")
+    input_data, exact_solution = extract_data_from_output(text_data)
+    apply_verification_settings(input_data)
+
+    # Run the metaheuristic to find a solution and evaluate the exact solution
+    start_time = perf_counter()
+    runner = Runner(5000, -1, use_multiprocessing=False)
+    best_solution: Individual = runner.run()
+    end_time = perf_counter()
+
+    # print(f"Row {row}: Pretty output:\n{best_solution.pretty_route_output()}")
+    print(f"Row {row}: Run time: {end_time - start_time}")
+
+    eval_results = Individual.reconstruct_solution(exact_solution)
+
+    return dict(exact_routes=exact_solution, exact_objective=eval_results.get_penalised_cost(),
+                meta_routes=best_solution.routes_to_dict(), pretty_meta_routes=best_solution.pretty_route_output(),
+                meta_time=end_time - start_time, meta_objective=best_solution.get_penalised_cost(1))
+
+
 if __name__ == "__main__":
     """Verify the metaheuristic against all mathematical instances."""
     # start_row = 38  # The row to start on
@@ -401,56 +425,68 @@ if __name__ == "__main__":
     do_simple_evaluation = True
     eval_cells_in_cols = ["J", "N"]
     verify_constraints_met = False
-
-    for row in rows_to_validate:
-        print(f"\nVerifying row {row}\n")
-
-        if run_metaheuristic:
-            # Extract the exact data and run the metaheuristic to find a solution and evaluate the exact solution
-            text_data = get_exact_output_data_from_sheet(row)
-            input_data, exact_solution = extract_data_from_output(text_data)
-            apply_verification_settings(input_data)
-
-            start_time = perf_counter()
-            runner = Runner(5000, -1, use_multiprocessing=False)
-            best_solution: Individual = runner.run()
-            end_time = perf_counter()
-
-            # print(f"Row {row}: Pretty output:\n{best_solution.pretty_route_output()}")
-            print(f"Row {row}: Run time: {end_time - start_time}")
-
-            best_solution_routes = best_solution.routes_to_dict()
-            eval_results = Individual.reconstruct_solution(exact_solution)
-
-            write_data_to_sheet(row=row, exact_routes=exact_solution, exact_objective=eval_results.get_penalised_cost(),
-                                meta_routes=best_solution.routes_to_dict(),
-                                pretty_meta_routes=best_solution.pretty_route_output(), meta_time=end_time - start_time,
-                                meta_objective=best_solution.get_penalised_cost(1))
-        else:
-            # Extract the exact data and solution, as well as the metaheuristic solution.
-            text_data = get_exact_output_data_from_sheet(row)
-            input_data, exact_solution = extract_data_from_output(text_data)
-            apply_verification_settings(input_data)
-
-            best_solution_routes = ArcRoute.load_json_routes("Solve Times Summary.xlsx", "Run Data", f"N{row}")
-
-        if do_simple_evaluation:
-            # Evaluate both solutions fairly, purely based on the objective function of the model.
-            simple_exact_objective = evaluate_solution_simply(exact_solution)
-            simple_meta_objective = evaluate_solution_simply(best_solution_routes)
-
-            write_data_to_sheet(row=row, simple_exact_objective=simple_exact_objective,
-                                simple_meta_objective=simple_meta_objective)
-
-        for col in eval_cells_in_cols:
-
-            solution = Individual.reconstruct_solution(
-                ArcRoute.load_json_routes("Solve Times Summary.xlsx", "Run Data", f"{col}{row}"))
-            print(solution)
-            print(solution.pretty_route_output())
-
-            if verify_constraints_met:
-                # Verify that the solution meets all the mathematical model constraints
+    # Verifying rows at the same time makes the metaheuristic run times depend on how many rows share the CPU, so the
+    # rows are verified one at a time unless the run times don't matter.
+    verify_rows_in_parallel = False
+
+    summary_filename = "Solve Times Summary.xlsx"
+
+    # Read the exact data (and the metaheuristic solution, if it isn't being run again) for every row in one pass
+    with open_read_only(summary_filename) as inputs_workbook:
+        text_datas = [get_exact_output_data_from_sheet(row, workbook=inputs_workbook) for row in rows_to_validate]
+        saved_meta_routes = [None if run_metaheuristic else
+                             ArcRoute.load_json_routes(summary_filename, "Run Data", f"N{row}",
+                                                       workbook=inputs_workbook) for row in rows_to_validate]
+
+    executor = ProcessPoolExecutor() if verify_rows_in_parallel and run_metaheuristic else None
+    try:
+        map_rows = executor.map if executor else map
+        # Only the metaheuristic runs are shared out, and their results come back in the same order as the rows
+        all_results = map_rows(verify_row, rows_to_validate, text_datas) if run_metaheuristic else repeat(None)
+
+        for row, text_data, meta_routes, results in zip(rows_to_validate, text_datas, saved_meta_routes, all_results):
+            summary_workbook: Optional[Workbook] = None
+            if results is not None:
+                # Save the row's results as soon as they are ready, so that a failure in the evaluation below doesn't
+                # lose them. The workbook is only loaded now, so that anything else written to it during the runs is
+                # kept.
+                summary_workbook = load_workbook(filename=summary_filename)
+                write_data_to_sheet(row=row, workbook=summary_workbook, **results)
+                summary_workbook.save(summary_filename)
+                exact_solution, meta_routes = results["exact_routes"], results["meta_routes"]
+                if executor is not None:
+                    # The row was verified in another process, so its settings are applied here as well
+                    apply_verification_settings(extract_data_from_output(text_data)[0])
+            else:
+                # Extract the exact data and solution, as the metaheuristic wasn't run for this row
+                print(f"\nVerifying row {row}\n")
+                input_data, exact_solution = extract_data_from_output(text_data)
+                apply_verification_settings(input_data)
+
+            if do_simple_evaluation:
+                # Evaluate both solutions fairly, purely based on the objective function of the model.
+                simple_exact_objective = evaluate_solution_simply(exact_solution)
+                simple_meta_objective = evaluate_solution_simply(meta_routes)
+
+                summary_workbook = load_workbook(filename=summary_filename)
+                write_data_to_sheet(row=row, workbook=summary_workbook, simple_exact_objective=simple_exact_objective,
+                                    simple_meta_objective=simple_meta_objective)
+                summary_workbook.save(summary_filename)
+
+            for col in eval_cells_in_cols:
+
+                # The saved routes are read back from the workbook that was last saved, if there is one
                 solution = Individual.reconstruct_solution(
-                    ArcRoute.load_json_routes("Solve Times Summary.xlsx", "Run Data", f"{col}{row}"))
-                verify_constraints(solution)
+                    ArcRoute.load_json_routes(summary_filename, "Run Data", f"{col}{row}", workbook=summary_workbook))
+                print(solution)
+                print(solution.pretty_route_output())
+
+                if verify_constraints_met:
+                    # Verify that the solution meets all the mathematical model constraints
+                    solution = Individual.reconstruct_solution(
+                        ArcRoute.load_json_routes(summary_filename, "Run Data", f"{col}{row}",
+                                                  workbook=summary_workbook))
+                    verify_constraints(solution)
+    finally:
+        if executor:
+            executor.shutdown()